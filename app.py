@@ -4,6 +4,7 @@ import io
 import csv
 import zipfile
 import json
+import re
 
 app = Flask(__name__)
 db = EmailBackend()
@@ -60,12 +61,39 @@ def add_tag():
     db.add_tag(request.json['id'], request.json['tag'])
     return jsonify({'status': 'ok'})
 
+@app.route('/api/tag/bulk', methods=['POST'])
+def bulk_tag():
+    db.bulk_op(request.json['ids'], 'tag', request.json['tag'])
+    return jsonify({'status': 'ok'})
+
+@app.route('/api/rules', methods=['GET', 'POST'])
+def rules():
+    if request.method == 'POST':
+        r = request.json
+        try: rid = db.add_rule(r['field'], r['op'], r['pattern'], r['action'], r['value'])
+        except (ValueError, re.error) as e: return jsonify({'error': str(e)}), 400
+        return jsonify({'status': 'ok', 'id': rid})
+    return jsonify(db.get_rules())
+
+@app.route('/api/rules/<int:rid>', methods=['PATCH', 'DELETE'])
+def edit_rule(rid):
+    if request.method == 'DELETE': db.delete_rule(rid)
+    else: db.set_rule_enabled(rid, request.json.get('enabled', True))
+    return jsonify({'status': 'ok'})
+
+@app.route('/api/rules/run', methods=['POST'])
+def run_rules():
+    """Re-categorizes the whole store and reports per-rule hits and cost"""
+    return jsonify(db.run_rules())
+
 @app.route('/import', methods=['POST'])
 def run_import():
     path = request.form.get('path')
-    def prog(c, t): print(f"\rImporting: {c}/{t}", end="")
-    success, msg = db.import_mbox(path, prog)
-    return jsonify({'success': success, 'message': msg})
+    def prog(c): print(f"\rImporting: {c}", end="")
+    result = db.import_mbox(path, prog)
+    if result is None: return jsonify({'success': False, 'message': f"Not found: {path}"})
+    count, report = result
+    return jsonify({'success': True, 'message': f"Processed {count} messages", 'rules': report})
 
 # --- ADVANCED EXPORT ENGINE ---
 
@@ -4,19 +4,102 @@ import os
 import datetime
 import re
 import json
+import time
+import heapq
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from email.header import decode_header
 from email.utils import parsedate_to_datetime
 
+from rules import RuleSet, FIELDS, OPS, ACTIONS, normalize_field
+from writebehind import WriteBehind, FLAG_COLS
+
 DB_NAME = "local_emails.db"
+SHARD_BY = os.environ.get("INBOX_SHARD_BY", "")   # "", "account", "year" or "account,year"
+SHARD_KEYS = ('account', 'year')
+COLD_SHARD_YEARS = 2       # year shards older than this open read-only with mmap
+SHARD_ID_BITS = 32         # email ids are (shard_no << SHARD_ID_BITS) + local rowid
+MMAP_SIZE = 256 * 1024 * 1024
+SEARCH_LIMIT = 2000
+UPDATE_CHUNK = 900         # ids per "WHERE id IN (...)" statement
+
+SORTS = {
+    'newest': ("timestamp DESC", 'timestamp', True),
+    'oldest': ("timestamp ASC", 'timestamp', False),
+    'size': ("size_bytes DESC", 'size_bytes', True),
+    'alpha': ("subject ASC", 'subject', False),
+    'links': ("link_count DESC", 'link_count', True),
+}
+
+class Shard:
+    """One SQLite file holding a slice of the emails table."""
+    def __init__(self, no, path, account=None, year=None, conn=None):
+        self.no, self.path, self.account, self.year = no, path, account, year
+        self.readonly = False
+        self.lock = threading.Lock()
+        self.retired = []   # read-only connections other threads may still be reading from
+        self.conn = conn or self._open()
+
+    def _open(self):
+        cold = self.year is not None and self.year < datetime.date.today().year - COLD_SHARD_YEARS
+        if cold and os.path.exists(self.path):
+            conn = sqlite3.connect(f"file:{os.path.abspath(self.path)}?mode=ro", uri=True, check_same_thread=False)
+            conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+            self.readonly = True
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def writable(self):
+        """Reopens a cold read-only shard for writing on first mutation."""
+        with self.lock:
+            if self.readonly:
+                conn = sqlite3.connect(self.path, check_same_thread=False)
+                conn.row_factory = sqlite3.Row
+                self.retired.append(self.conn)
+                self.conn, self.readonly = conn, False
+            return self.conn
+
+    def close(self):
+        for conn in [self.conn] + self.retired: conn.close()
+
+    def covers(self, f):
+        """Shard pruning only; the query itself still applies every filter, so when in doubt say yes."""
+        if f.get('account') and self.account not in (None, f['account']): return False
+        if self.year is None: return True
+        lo = datetime.datetime(self.year, 1, 1).timestamp()
+        hi = datetime.datetime(self.year + 1, 1, 1).timestamp()
+        try:
+            if f.get('date_after') and float(f['date_after']) >= hi: return False
+            if f.get('date_before') and float(f['date_before']) < lo: return False
+        except (TypeError, ValueError): pass
+        return True
+
+    def seeded_no(self):
+        """Shard number recorded in an existing file's id sequence, if any."""
+        try: row = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name='emails'").fetchone()
+        except sqlite3.Error: return None
+        return row[0] >> SHARD_ID_BITS if row else None
 
 class EmailBackend:
-    def __init__(self):
+    def __init__(self, shard_by=SHARD_BY):
+        self.shard_by = [k.strip() for k in shard_by.split(",") if k.strip()]
+        if set(self.shard_by) - set(SHARD_KEYS):
+            raise ValueError(f"Invalid shard_by {shard_by!r}: use {', '.join(SHARD_KEYS)} or both")
         self.conn = sqlite3.connect(DB_NAME, check_same_thread=False)
         self.conn.row_factory = sqlite3.Row
+        self.shard_lock = threading.RLock()
+        fresh = not self.conn.execute("SELECT 1 FROM sqlite_master WHERE name='uids'").fetchone()
         self._init_db()
+        self._load_shards()
+        if fresh: self._index_uids()
+        self.writes = WriteBehind(self)
 
-    def _init_db(self):
-        c = self.conn.cursor()
+    def _init_emails(self, conn):
+        """The per-shard schema: the emails table and its FTS index."""
+        c = conn.cursor()
         c.execute('''
             CREATE TABLE IF NOT EXISTS emails (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -28,9 +111,17 @@ class EmailBackend:
                 has_attachment INTEGER, attachment_count INTEGER, attachment_types TEXT, attachment_names TEXT,
                 folder TEXT, category TEXT,
                 is_starred INTEGER DEFAULT 0, is_read INTEGER DEFAULT 1, is_newsletter INTEGER DEFAULT 0, is_deleted INTEGER DEFAULT 0,
-                headers_json TEXT, body TEXT, html_body TEXT, tags TEXT DEFAULT ''
+                headers_json TEXT, body TEXT, html_body TEXT, tags TEXT DEFAULT '', account TEXT
             )
         ''')
+        if 'account' not in [r[1] for r in c.execute("PRAGMA table_info(emails)")]:
+            c.execute("ALTER TABLE emails ADD COLUMN account TEXT")
+        c.execute('CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(sender, subject, body, tags, content=emails, content_rowid=id)')
+        conn.commit()
+
+    def _init_db(self):
+        self._init_emails(self.conn)
+        c = self.conn.cursor()
         c.execute('CREATE TABLE IF NOT EXISTS folders (name TEXT PRIMARY KEY, type TEXT, icon TEXT)')
         if c.execute("SELECT count(*) FROM folders").fetchone()[0] == 0:
             sys = [('Inbox','system','📥'), ('Starred','system','⭐'), ('Sent','system','✈️'), 
@@ -38,10 +129,66 @@ class EmailBackend:
                    ('Bin','system','🗑️'), ('Snoozed','system','💤')]
             c.executemany("INSERT OR IGNORE INTO folders VALUES (?,?,?)", sys)
         
-        c.execute('CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(sender, subject, body, tags, content=emails, content_rowid=id)')
         c.execute('CREATE TABLE IF NOT EXISTS search_history (query TEXT PRIMARY KEY, timestamp REAL)')
+        c.execute('CREATE TABLE IF NOT EXISTS rules (id INTEGER PRIMARY KEY AUTOINCREMENT, field TEXT, op TEXT, pattern TEXT, action TEXT, value TEXT, enabled INTEGER DEFAULT 1)')
+        c.execute('CREATE TABLE IF NOT EXISTS uids (uid TEXT PRIMARY KEY, shard INTEGER)')
+        c.execute('CREATE TABLE IF NOT EXISTS shards (no INTEGER PRIMARY KEY, name TEXT UNIQUE, path TEXT, account TEXT, year INTEGER)')
+        self.conn.commit()
+
+    # --- SHARDS ---
+    def _load_shards(self):
+        # Shard 0 is the main database file itself, so unsharded stores keep working unchanged.
+        self.shards = {0: Shard(0, DB_NAME, conn=self.conn)}
+        for r in self.conn.execute("SELECT * FROM shards ORDER BY no"):
+            self.shards[r['no']] = Shard(r['no'], r['path'], r['account'], r['year'])
+        self.pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="shard")
+
+    def _index_uids(self):
+        # uids is the cross-shard dedupe index; build it once for stores that predate it.
+        for s in list(self.shards.values()):
+            uids = [(r[0], s.no) for r in s.conn.execute("SELECT uid FROM emails WHERE uid IS NOT NULL")]
+            self.conn.executemany("INSERT OR IGNORE INTO uids VALUES (?,?)", uids)
         self.conn.commit()
 
+    def _shard_for(self, account, ts):
+        if not self.shard_by: return self.shards[0]
+        acct = account if 'account' in self.shard_by else None
+        year = datetime.datetime.fromtimestamp(ts).year if 'year' in self.shard_by else None
+        name = re.sub(r"[^\w.-]", "_", "-".join(str(x) for x in (acct, year) if x is not None))
+        with self.shard_lock:
+            for s in list(self.shards.values()):
+                if s.no and (s.account, s.year) == (acct, year): return s
+            path = f"{os.path.splitext(DB_NAME)[0]}.{name}.db"
+            s = Shard(None, path, acct, year)
+            s.writable()
+            # A file left behind by an interrupted import keeps the number its ids were seeded with
+            no = s.seeded_no()
+            if no is None or no in self.shards: no = max(self.shards) + 1
+            s.no = no
+            self._init_emails(s.conn)
+            s.conn.execute("INSERT INTO sqlite_sequence (name, seq) SELECT 'emails', ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name='emails')", (no << SHARD_ID_BITS,))
+            s.conn.commit()
+            self.conn.execute("INSERT INTO shards VALUES (?,?,?,?,?)", (no, name, path, acct, year))
+            self.conn.commit()
+            self.shards[no] = s   # published only once fully initialised
+            return s
+
+    def _shard_of(self, eid):
+        return self.shards.get(int(eid) >> SHARD_ID_BITS, self.shards[0])
+
+    def _fan_out(self, fn, shards=None):
+        shards = list(self.shards.values()) if shards is None else shards
+        if len(shards) == 1: return [fn(shards[0])]
+        return list(self.pool.map(fn, shards))
+
+    def _group_ids(self, ids):
+        groups = {}
+        for i in ids: groups.setdefault(self._shard_of(i), []).append(int(i))
+        return groups.items()
+
+    def _chunks(self, ids):
+        for k in range(0, len(ids), UPDATE_CHUNK): yield ids[k:k + UPDATE_CHUNK]
+
     def complex_search(self, f):
         """Master Filter Engine"""
         q = ["SELECT * FROM emails WHERE is_deleted = 0"]
@@ -52,10 +199,11 @@ class EmailBackend:
             if f['folder'] == 'Starred': q.append("AND is_starred = 1")
             elif f['folder'] != 'All Mail': q.append("AND folder = ?"); p.append(f['folder'])
         if f.get('category') and f.get('folder') == 'Inbox': q.append("AND category = ?"); p.append(f['category'])
+        if f.get('account'): q.append("AND account = ?"); p.append(f['account'])
 
         # 2. Text (FTS)
         if f.get('q'):
-            self.conn.execute("INSERT OR REPLACE INTO search_history VALUES (?, ?)", (f['q'], datetime.datetime.now().timestamp()))
+            self.writes.record_search(f['q'], datetime.datetime.now().timestamp())
             q.append("AND id IN (SELECT rowid FROM emails_fts WHERE emails_fts MATCH ?)"); p.append(f['q'])
         
         # 3. Content Filters (New Features)
@@ -84,41 +232,139 @@ class EmailBackend:
         if f.get('min_size'): q.append("AND size_bytes >= ?"); p.append(f['min_size'])
 
         # Sorting
-        sort = f.get('sort', 'newest')
-        order = "timestamp DESC"
-        if sort == 'oldest': order = "timestamp ASC"
-        elif sort == 'size': order = "size_bytes DESC"
-        elif sort == 'alpha': order = "subject ASC"
-        elif sort == 'links': order = "link_count DESC"
-        
-        q.append(f"ORDER BY {order} LIMIT 2000")
-        return [dict(r) for r in self.conn.execute(" ".join(q), tuple(p)).fetchall()]
+        order, key, desc = SORTS.get(f.get('sort', 'newest'), SORTS['newest'])
+        q.append(f"ORDER BY {order} LIMIT {SEARCH_LIMIT}")
+        sql, p = " ".join(q), tuple(p)
+        if (f.get('read') or f.get('folder') == 'Starred') and self.writes.touches(FLAG_COLS): self.writes.flush()
+
+        # Fan out over the shards this filter can touch, then k-way merge by the sort key
+        shards = [s for s in list(self.shards.values()) if s.covers(f)]
+        runs = self._fan_out(lambda s: [self.writes.overlay(dict(r)) for r in s.conn.execute(sql, p).fetchall()], shards)
+        if len(runs) == 1: return runs[0]
+        merged = heapq.merge(*runs, key=lambda r: (r[key] is not None, r[key]), reverse=desc)
+        return list(itertools.islice(merged, SEARCH_LIMIT))
+
+    def get_email(self, eid):
+        row = self._shard_of(eid).conn.execute("SELECT * FROM emails WHERE id=?", (eid,)).fetchone()
+        return self.writes.overlay(dict(row)) if row else None
 
     # --- ACTIONS ---
     def toggle_flag(self, eid, col):
-        curr = self.conn.execute(f"SELECT {col} FROM emails WHERE id=?", (eid,)).fetchone()[0]
-        self.conn.execute(f"UPDATE emails SET {col}=? WHERE id=?", (0 if curr else 1, eid))
-        self.conn.commit()
+        if col in FLAG_COLS: return self.writes.toggle(eid, col)
+        with self.writes.direct():
+            conn = self._shard_of(eid).writable()
+            curr = conn.execute(f"SELECT {col} FROM emails WHERE id=?", (eid,)).fetchone()[0]
+            conn.execute(f"UPDATE emails SET {col}=? WHERE id=?", (0 if curr else 1, eid))
+            conn.commit()
 
     def bulk_op(self, ids, op, val=None):
         if not ids: return
-        p = ",".join(["?"]*len(ids))
-        if op == 'move': self.conn.execute(f"UPDATE emails SET folder=? WHERE id IN ({p})", (val, *ids))
-        elif op == 'delete': self.conn.execute(f"UPDATE emails SET is_deleted=1, folder='Bin' WHERE id IN ({p})", ids)
-        elif op == 'read': self.conn.execute(f"UPDATE emails SET is_read=? WHERE id IN ({p})", (val, *ids))
-        self.conn.commit()
+        if op == 'read': return self.writes.set(ids, 'is_read', int(val))
+        with self.writes.direct():
+            for shard, sids in self._group_ids(ids):
+                conn = shard.writable()
+                p = ",".join(["?"]*len(sids))
+                if op == 'move': conn.execute(f"UPDATE emails SET folder=? WHERE id IN ({p})", (val, *sids))
+                elif op == 'delete': conn.execute(f"UPDATE emails SET is_deleted=1, folder='Bin' WHERE id IN ({p})", sids)
+                elif op == 'tag': conn.execute(f"UPDATE emails SET tags=trim(coalesce(tags,'') || ' ' || ?) WHERE id IN ({p}) AND instr(' ' || coalesce(tags,'') || ' ', ' ' || ? || ' ') = 0", (val, *sids, val))
+                conn.commit()
+
+    def add_tag(self, eid, tag):
+        self.bulk_op([eid], 'tag', tag.strip())
 
     def get_stats(self):
-        ur = dict(self.conn.execute("SELECT folder, COUNT(*) FROM emails WHERE is_read=0 AND is_deleted=0 GROUP BY folder").fetchall())
-        return {'unread': ur}
+        ur = {}
+        sql = "SELECT folder, COUNT(*) FROM emails WHERE is_read=0 AND is_deleted=0 GROUP BY folder"
+        for rows in self._fan_out(lambda s: s.conn.execute(sql).fetchall()):
+            for folder, n in rows: ur[folder] = ur.get(folder, 0) + n
+        for folder, d in self.writes.unread_delta().items(): ur[folder] = ur.get(folder, 0) + d
+        return {'unread': {k: v for k, v in ur.items() if v > 0}}
+
+    def close(self):
+        self.writes.close()
+        self.pool.shutdown()
+        for s in list(self.shards.values()): s.close()
+
+    # --- RULES ---
+    def add_rule(self, field, op, pattern, action, value):
+        if not (field in FIELDS or field.startswith("header:")) or op not in OPS or action not in ACTIONS:
+            raise ValueError(f"Invalid rule: {field} {op} -> {action}")
+        field = normalize_field(field)
+        if op == 'regex': re.compile(pattern)
+        if op in ('min', 'max'):
+            if field != 'size': raise ValueError(f"{op} only applies to size, not {field}")
+            try: pattern = str(int(pattern))
+            except ValueError: raise ValueError(f"{op} needs a size in bytes, got {pattern!r}") from None
+        cur = self.conn.execute("INSERT INTO rules (field, op, pattern, action, value) VALUES (?,?,?,?,?)", (field, op, pattern, action, value))
+        self.conn.commit()
+        return cur.lastrowid
+
+    def set_rule_enabled(self, rid, enabled):
+        self.conn.execute("UPDATE rules SET enabled=? WHERE id=?", (1 if enabled else 0, rid))
+        self.conn.commit()
+
+    def delete_rule(self, rid):
+        self.conn.execute("DELETE FROM rules WHERE id=?", (rid,))
+        self.conn.commit()
+
+    def get_rules(self):
+        return [dict(r) for r in self.conn.execute("SELECT * FROM rules ORDER BY id")]
+
+    def load_rules(self):
+        return RuleSet(self.conn.execute("SELECT * FROM rules WHERE enabled = 1 ORDER BY id").fetchall())
+
+    def run_rules(self):
+        """Re-applies every enabled rule to the whole store: one scan per shard, then set-based updates.
+
+        Per-rule cost covers regex and size rules; exact-match lookups are timed per field under 'fields'.
+        """
+        start, rules = time.perf_counter(), self.load_rules()
+        if not rules: return {'rows': 0, 'updated': 0, 'seconds': 0.0, 'rules': [], 'fields': {}, 'rechecks': {}}
+        cols = "id, sender_addr, sender_domain, subject, size_bytes, category, folder, tags" + (", headers_json" if rules.headers else "")
+
+        def run(shard):
+            stats, changes, rows = rules.new_stats(), {}, 0
+            for r in shard.conn.execute(f"SELECT {cols} FROM emails WHERE is_deleted = 0"):
+                row = dict(r); rows += 1
+                if rules.headers: row['headers'] = json.loads(row.pop('headers_json') or "{}")
+                for col, val in rules.apply(row, stats).items():
+                    changes.setdefault((col, val), []).append(row['id'])
+            updated = set()
+            if changes:
+                conn = shard.writable()
+                for (col, val), ids in changes.items():
+                    updated.update(ids)
+                    for chunk in self._chunks(ids):
+                        conn.execute(f"UPDATE emails SET {col}=? WHERE id IN ({','.join(['?']*len(chunk))})", (val, *chunk))
+                conn.commit()
+            return rows, len(updated), stats
+
+        total = rules.new_stats()
+        rows = updated = 0
+        with self.writes.direct(): results = self._fan_out(run)
+        for n, u, stats in results:
+            rows += n; updated += u
+            for k in total: total[k].update(stats[k])
+        return {'rows': rows, 'updated': updated, 'seconds': round(time.perf_counter() - start, 3),
+                'rules': rules.report(total), 'fields': {k: round(v, 6) for k, v in total['fields'].items()},
+                'rechecks': dict(total['rechecks'])}
 
     # --- IMPORT ---
-    def import_mbox(self, path, cb=None):
+    def import_mbox(self, path, cb=None, account=None):
+        """Returns (messages processed, per-rule report), or None if path does not exist."""
+        with self.writes.direct(): return self._import_mbox(path, cb, account)
+
+    def _import_mbox(self, path, cb, account):
         if not os.path.exists(path): return
         mbox = mailbox.mbox(path)
-        self.conn.execute("BEGIN")
+        account = account or os.path.splitext(os.path.basename(path))[0]
+        touched, seen, i = set(), {}, -1
+        rules, stats = self.load_rules(), RuleSet.new_stats()
         for i, msg in enumerate(mbox):
             try:
+                uid = msg.get('Message-ID', f"loc-{i}")
+                if uid in seen or self.conn.execute("SELECT 1 FROM uids WHERE uid=?", (uid,)).fetchone(): continue
+
                 def clean(h): 
                     return "".join([str(t[0], t[1] or 'utf-8', 'ignore') if isinstance(t[0], bytes) else str(t[0]) for t in decode_header(h or "")])
                 
@@ -158,18 +404,30 @@ class EmailBackend:
                 elif 'Updates' in lbls: cat = 'updates'
 
                 links = html.count('<a href') + body.count('http')
+                size = len(msg.as_bytes())
+
+                # User Rules
+                row = {'sender_addr': addr, 'sender_domain': dom, 'subject': sub, 'size_bytes': size,
+                       'headers': dict(msg.items()), 'category': cat, 'folder': 'Inbox', 'tags': ''}
+                if rules: row.update(rules.apply(row, stats))
                 
-                self.conn.execute('''INSERT OR IGNORE INTO emails 
+                shard = self._shard_for(account, ts)
+                touched.add(shard)
+                cur = shard.writable().execute('''INSERT OR IGNORE INTO emails 
                     (uid, sender, sender_name, sender_addr, sender_domain, subject, date_str, timestamp, day_of_week,
-                     body, html_body, folder, category, has_attachment, attachment_names, attachment_types, 
-                     size_bytes, link_count, is_newsletter, headers_json)
-                    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
-                    (msg.get('Message-ID', f"loc-{i}"), frm, name.strip(), addr, dom, sub, msg['date'], ts, day,
-                     body, html, 'Inbox', cat, 1 if atts else 0, ";".join(atts), 
-                     ",".join({os.path.splitext(x)[1] for x in atts}), len(msg.as_bytes()), links,
-                     1 if msg.get('List-Unsubscribe') else 0, json.dumps(dict(msg.items()))))
+                     body, html_body, folder, category, tags, has_attachment, attachment_names, attachment_types, 
+                     size_bytes, link_count, is_newsletter, headers_json, account)
+                    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
+                    (uid, frm, name.strip(), addr, dom, sub, msg['date'], ts, day,
+                     body, html, row['folder'], row['category'], row['tags'], 1 if atts else 0, ";".join(atts), 
+                     ",".join({os.path.splitext(x)[1] for x in atts}), size, links,
+                     1 if msg.get('List-Unsubscribe') else 0, json.dumps(row['headers']), account))
+                if cur.rowcount: seen[uid] = shard.no
                 
                 if cb and i % 50 == 0: cb(i)
             except: continue
-        self.conn.execute("COMMIT")
-        return i
+        for shard in touched: shard.conn.commit()
+        # Recorded only after the emails themselves are committed, so a crash never leaves a uid without its message
+        self.conn.executemany("INSERT OR IGNORE INTO uids VALUES (?,?)", seen.items())
+        self.conn.commit()
+        return i + 1, rules.report(stats)
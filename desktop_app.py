@@ -294,7 +294,7 @@ class InboxManager(QMainWindow):
 
     def load_mail(self, item):
         eid = item.data(Qt.ItemDataRole.UserRole)
-        d = self.db.conn.execute("SELECT * FROM emails WHERE id=?", (eid,)).fetchone()
+        d = self.db.get_email(eid)
         
         # Mark Read
         if not d['is_read']:
@@ -314,6 +314,10 @@ class InboxManager(QMainWindow):
         self.is_compact = not self.is_compact
         self.refresh_list()
 
+    def closeEvent(self, e):
+        self.db.close()
+        super().closeEvent(e)
+
     # --- ACTIONS ---
     def context_menu(self, pos):
         m = QMenu()
@@ -337,9 +341,11 @@ class InboxManager(QMainWindow):
     def import_mbox(self):
         p, _ = QFileDialog.getOpenFileName(self, "Import", "", "MBOX (*.mbox)")
         if p:
-            self.db.import_mbox(p, lambda c: print(f"\r{c}", end=""))
+            result = self.db.import_mbox(p, lambda c: print(f"\r{c}", end=""))
             self.refresh_list()
             self.refresh_sidebar()
+            hits = [f"{r['field']} {r['op']} {r['pattern']} → {r['action']} {r['value']}: {r['hits']}" for r in (result or (0, []))[1] if r['hits']]
+            if hits: QMessageBox.information(self, "Import", "Rule hits:\n" + "\n".join(hits))
 
     # --- EXPORT LOGIC ---
     def open_export(self):
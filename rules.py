@@ -0,0 +1,101 @@
+import re
+import time
+import itertools
+from collections import Counter
+
+# Rule fields map onto email columns; "header:<Name>" matches a raw header value.
+FIELDS = {'sender': 'sender_addr', 'domain': 'sender_domain', 'subject': 'subject', 'size': 'size_bytes'}
+OPS = ('is', 'regex', 'min', 'max')
+ACTIONS = ('category', 'folder', 'tag')
+
+def normalize_field(field):
+    """Header names are case-insensitive, so header rules are keyed by the lowercased name."""
+    return "header:" + field.split(":", 1)[1].strip().lower() if field.startswith("header:") else field
+
+def add_tag(tags, tag):
+    tags = tags or ""
+    return tags if tag in tags.split() else f"{tags} {tag}".strip()
+
+class RuleSet:
+    """All enabled rules compiled into hash lookups and one combined regex per field.
+
+    Rules are evaluated in id order: the first matching category/folder rule wins, tags accumulate.
+    Exact ('is') rules share one dict lookup per field, so their cost is reported under 'fields', not per rule.
+    Group-free regexes are joined as named alternatives; rules they confirm are hits outright, but since
+    matches can overlap, a hit still forces the unconfirmed ones to be re-checked. That worst case is
+    counted per field under 'rechecks'.
+    """
+    def __init__(self, rules):
+        self.rules = [dict(r) for r in rules]
+        self.by_id = {r['id']: r for r in self.rules}
+        self.exact = {}     # field -> {lowered value: [rule ids]}
+        self.regex = {}     # field -> (combined prefilter or None, [(rule id, compiled)], [(rule id, compiled)] unfiltered)
+        self.ranges = []    # (rule id, op, bytes); only size supports min/max
+        grouped = {}
+        for r in self.rules:
+            r['field'] = normalize_field(r['field'])
+            if r['op'] == 'is': self.exact.setdefault(r['field'], {}).setdefault(r['pattern'].lower(), []).append(r['id'])
+            elif r['op'] == 'regex': grouped.setdefault(r['field'], []).append(r)
+            elif r['op'] in ('min', 'max') and r['field'] == 'size': self.ranges.append((r['id'], r['op'], int(r['pattern'])))
+        for field, rs in grouped.items():
+            compiled = [(r['id'], re.compile(r['pattern'], re.I)) for r in rs]
+            # Group numbers shift once patterns are joined, so anything with groups (backreferences) is checked alone
+            plain = [(rid, rx) for rid, rx in compiled if rx.groups == 0]
+            try: combined = re.compile("|".join(f"(?P<r{rid}>{rx.pattern})" for rid, rx in plain), re.I) if plain else None
+            except re.error: combined, plain = None, []   # e.g. mid-pattern inline flags
+            self.regex[field] = (combined, plain, [c for c in compiled if c not in plain])
+        self.headers = {f.split(":", 1)[1] for f in itertools.chain(self.exact, self.regex) if f.startswith("header:")}
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    @staticmethod
+    def new_stats():
+        return {'hits': Counter(), 'cost': Counter(), 'fields': Counter(), 'rechecks': Counter()}
+
+    @staticmethod
+    def _value(row, field):
+        if field.startswith("header:"): return row['lheaders'].get(field.split(":", 1)[1], "")
+        return row.get(FIELDS.get(field, field))
+
+    def match(self, row, stats):
+        hits = []
+        if self.headers:
+            row = {**row, 'lheaders': {k.lower(): v for k, v in (row.get('headers') or {}).items()}}
+        for field, table in self.exact.items():
+            t = time.perf_counter()
+            hits += table.get(str(self._value(row, field) or "").lower(), ())
+            stats['fields'][field] += time.perf_counter() - t
+        for field, (combined, plain, alone) in self.regex.items():
+            t = time.perf_counter()
+            v = str(self._value(row, field) or "")
+            found = {int(m.lastgroup[1:]) for m in combined.finditer(v)} if combined else set()
+            stats['fields'][field] += time.perf_counter() - t
+            hits += found
+            rest = [c for c in plain if c[0] not in found] if found else []
+            stats['rechecks'][field] += len(rest)
+            for rid, rx in rest + alone:
+                t = time.perf_counter()
+                if rx.search(v): hits.append(rid)
+                stats['cost'][rid] += time.perf_counter() - t
+        size = row.get('size_bytes') or 0
+        for rid, op, n in self.ranges:
+            t = time.perf_counter()
+            if (size >= n) if op == 'min' else (size <= n): hits.append(rid)
+            stats['cost'][rid] += time.perf_counter() - t
+        return sorted(hits)
+
+    def apply(self, row, stats):
+        """Returns the {column: value} changes the matching rules make to row."""
+        out, tags = {}, row.get('tags') or ""
+        for rid in self.match(row, stats):
+            r = self.by_id[rid]
+            stats['hits'][rid] += 1
+            if r['action'] == 'tag': tags = add_tag(tags, r['value'])
+            elif r['action'] not in out: out[r['action']] = r['value']
+        if tags != (row.get('tags') or ""): out['tags'] = tags
+        return {k: v for k, v in out.items() if k == 'tags' or v != row.get(k)}
+
+    def report(self, stats):
+        return [{**r, 'hits': stats['hits'][r['id']], 'cost': None if r['op'] == 'is' else round(stats['cost'][r['id']], 6)}
+                for r in self.rules]
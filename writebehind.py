@@ -0,0 +1,155 @@
+import atexit
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+FLUSH_INTERVAL = 1.0                  # seconds between a first queued write and its flush
+FLAG_COLS = ('is_read', 'is_starred')
+BASE_COLS = FLAG_COLS + ('folder', 'is_deleted')
+
+log = logging.getLogger(__name__)
+
+class WriteBehind:
+    """Coalesces small hot-path writes (flags, search history) and flushes them in one transaction per shard.
+
+    Queued values are overlaid on reads so the session always sees its own writes.
+    """
+    def __init__(self, backend, interval=FLUSH_INTERVAL):
+        self.db, self.interval = backend, interval
+        self.lock = threading.RLock()        # guards the in-memory state below
+        self.flush_lock = threading.RLock()  # serialises flushes with direct writes
+        self.pending, self.inflight = {}, {} # eid -> {col: val}
+        self.base = {}                       # eid -> committed BASE_COLS values
+        self.history = {}                    # query -> timestamp
+        self.timer = None
+        self.closed = False
+        atexit.register(self.close)
+
+    # --- QUEUE ---
+    def _load_base(self, ids):
+        missing = [i for i in ids if i not in self.base]
+        for shard, sids in self.db._group_ids(missing):
+            for chunk in self.db._chunks(sids):
+                p = ",".join(["?"]*len(chunk))
+                for r in shard.conn.execute(f"SELECT id, {', '.join(BASE_COLS)} FROM emails WHERE id IN ({p})", chunk):
+                    self.base[r['id']] = {c: r[c] for c in BASE_COLS}
+
+    def _schedule(self):
+        if self.timer is None:
+            self.timer = threading.Timer(self.interval, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def get(self, eid, col):
+        for layer in (self.pending, self.inflight, self.base):
+            if col in layer.get(eid, ()): return layer[eid][col]
+
+    def set(self, ids, col, val):
+        ids = [int(i) for i in ids]
+        with self.lock:
+            self._load_base(ids)
+            for eid in ids:
+                if eid in self.base: self.pending.setdefault(eid, {})[col] = val
+            self._schedule()
+
+    def toggle(self, eid, col):
+        eid = int(eid)
+        with self.lock:
+            self._load_base([eid])
+            if eid not in self.base: return
+            self.pending.setdefault(eid, {})[col] = 0 if self.get(eid, col) else 1
+            self._schedule()
+
+    def record_search(self, q, ts):
+        with self.lock:
+            self.history[q] = ts
+            self._schedule()
+
+    # --- READ-YOUR-WRITES ---
+    def overlay(self, row):
+        with self.lock:
+            for layer in (self.inflight, self.pending):
+                row.update(layer.get(row['id'], {}))
+        return row
+
+    def touches(self, cols):
+        with self.lock:
+            return any(c in v for layer in (self.pending, self.inflight) for v in layer.values() for c in cols)
+
+    def unread_delta(self):
+        """Per-folder change to unread counts that queued is_read writes will make."""
+        delta = {}
+        with self.lock:
+            for eid, base in self.base.items():
+                new = self.get(eid, 'is_read')
+                if base['is_deleted'] or new == base['is_read']: continue
+                delta[base['folder']] = delta.get(base['folder'], 0) + (1 if base['is_read'] else -1)
+        return delta
+
+    # --- FLUSH ---
+    def flush(self):
+        """Writes queued changes and returns True if everything is committed.
+
+        Anything that fails stays queued (in inflight) and is retried on the timer.
+        """
+        with self.flush_lock:
+            if self.closed: return not (self.pending or self.inflight or self.history)
+            with self.lock:
+                if self.timer: self.timer.cancel(); self.timer = None
+                for eid, cols in self.pending.items(): self.inflight.setdefault(eid, {}).update(cols)
+                self.pending = {}
+                history, self.history = self.history, {}
+            failed = False
+            if history:
+                try:
+                    self.db.conn.executemany("INSERT OR REPLACE INTO search_history VALUES (?, ?)", list(history.items()))
+                    self.db.conn.commit()
+                except sqlite3.Error:
+                    log.exception("Search history flush failed; will retry")
+                    self.db.conn.rollback()
+                    failed = True
+                    with self.lock:
+                        for q, ts in history.items(): self.history.setdefault(q, ts)
+            for shard, sids in self.db._group_ids(list(self.inflight)):
+                try:
+                    conn = shard.writable()
+                    for col in FLAG_COLS:
+                        rows = [(self.inflight[i][col], i) for i in sids if col in self.inflight[i]]
+                        if rows: conn.executemany(f"UPDATE emails SET {col}=? WHERE id=?", rows)
+                    conn.commit()
+                except sqlite3.Error:
+                    log.exception("Flag flush failed for %s; will retry", shard.path)
+                    shard.conn.rollback()
+                    failed = True
+                    continue
+                with self.lock:
+                    for eid in sids:
+                        cols = self.inflight.pop(eid)
+                        if eid in self.pending: self.base[eid].update(cols)
+                        else: self.base.pop(eid, None)
+            if failed:
+                with self.lock: self._schedule()
+            return not failed
+
+    @contextmanager
+    def direct(self):
+        """Flushes the queue and holds off the timer while the caller writes to the database itself.
+
+        Raises instead of letting the caller write past queued changes that could not be committed.
+        """
+        with self.flush_lock:
+            if not self.flush():
+                raise sqlite3.OperationalError("Queued writes could not be flushed; try again")
+            yield
+
+    def close(self):
+        """Final flush; after this the queue is inert, so a late timer or atexit never touches closed connections."""
+        with self.flush_lock:
+            if self.closed: return
+            ok = self.flush()
+            if not ok: log.error("Closing with unflushed writes: %d flag rows, %d searches", len(self.inflight), len(self.history))
+            self.closed = True
+            with self.lock:
+                if self.timer: self.timer.cancel(); self.timer = None
+        atexit.unregister(self.close)